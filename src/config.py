@@ -9,6 +9,13 @@ class IngestRawArticleDataParams(BaseModel):
     api_version = 1
     raw_data_bucket_name = "raw_article_data"
     intial_ingestion = True
+    # Archive API allows 500 requests per day and recommends 12 seconds between calls
+    daily_request_quota = 500
+    min_request_interval_seconds = 12
+    max_retries = 5
+    backoff_base_seconds = 15
+    backoff_max_seconds = 300
+    rate_limit_state_blob_name = "archive_api_rate_limit_state.json"
 
 
 class IngestInterimArticleDataParam(BaseModel):
@@ -26,3 +33,15 @@ class SyncArticleDataToBigquery(BaseModel):
     # location = "eu"  # location where data is stored
     table_id = "interim_article"
     source_uri = "gs://interim_article_data/interim_article_data_*.parquet"
+
+
+class CompactInterimArticleDataParams(BaseModel):
+    interim_data_bucket_name = "interim_article_data"
+    compacted_prefix = "compacted"  # Yearly files, one folder per compaction run
+    archive_prefix = "archive"  # Monthly files that have been compacted already
+    manifest_blob_name = "manifest.json"
+    pending_timeout_hours = 6  # Older pending swaps are from runs that crashed
+    superseded_retention_hours = 24  # Replaced files are kept for running queries
+    target_row_group_size = 50000
+    dataset_id = "ny_times"
+    table_id = "interim_article"
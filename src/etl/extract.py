@@ -1,6 +1,13 @@
 """ Collection of Extraction functions """
 
+from typing import Optional
+
+import pyarrow
 from google.cloud import storage
+from pyarrow import parquet
+
+# Bytes read from the end of a Parquet file, enough for the footer of most files
+PARQUET_FOOTER_BYTES = 64 * 1024
 
 
 def download_blob_to_file(
@@ -61,3 +68,68 @@ def download_blob_into_memory(bucket_name, blob_name) -> str:
     #     )
     # )
     return contents
+
+
+def list_blob_names(bucket_name, prefix=None) -> list[str]:
+    """Lists all the blob names in the bucket that begin with the prefix."""
+    # The ID of your GCS bucket
+    # bucket_name = "your-bucket-name"
+
+    # The prefix blob names have to start with
+    # prefix = "folder/file-prefix"
+
+    storage_client = storage.Client()
+
+    # Note: The call returns a response only when the iterator is consumed.
+    blobs = storage_client.list_blobs(bucket_name, prefix=prefix)
+
+    return [blob.name for blob in blobs]
+
+
+def download_blob_with_generation(
+    bucket_name, blob_name
+) -> tuple[Optional[bytes], int]:
+    """Downloads a blob into memory together with its generation.
+
+    Returns `None` and generation 0 if the blob doesn't exist, which matches
+    the `if_generation_match` precondition for creating it.
+    """
+    storage_client = storage.Client()
+
+    bucket = storage_client.bucket(bucket_name)
+
+    # Unlike `Bucket.blob`, `Bucket.get_blob` retrieves metadata incl. generation
+    blob = bucket.get_blob(blob_name)
+
+    if blob is None:
+        return None, 0
+
+    return blob.download_as_bytes(if_generation_match=blob.generation), blob.generation
+
+
+def blob_exists(bucket_name, blob_name) -> bool:
+    """Checks if a blob exists in the bucket."""
+    storage_client = storage.Client()
+
+    bucket = storage_client.bucket(bucket_name)
+
+    return bucket.blob(blob_name).exists()
+
+
+def download_parquet_schema(bucket_name, blob_name) -> pyarrow.Schema:
+    """Reads the schema of a Parquet blob, downloading only its footer."""
+    storage_client = storage.Client()
+
+    bucket = storage_client.bucket(bucket_name)
+    blob = bucket.get_blob(blob_name)
+
+    # A Parquet file ends with the metadata, its 4 byte length and b"PAR1"
+    tail = blob.download_as_bytes(start=max(blob.size - PARQUET_FOOTER_BYTES, 0))
+    metadata_length = int.from_bytes(tail[-8:-4], "little")
+    if metadata_length + 8 > len(tail):
+        tail = blob.download_as_bytes(start=blob.size - metadata_length - 8)
+
+    # The reader only needs the footer and the magic bytes to read the schema
+    footer = tail[-(metadata_length + 8) :]
+
+    return parquet.read_schema(pyarrow.BufferReader(b"PAR1" + footer))
@@ -1,12 +1,21 @@
 """ Collection of Load functions """
 
+from typing import Optional
+
 from google.cloud import storage
 
 
 def upload_blob_from_memory(
-    bucket_name: str, contents, destination_blob_name: str
+    bucket_name: str,
+    contents,
+    destination_blob_name: str,
+    if_generation_match: Optional[int] = None,
 ) -> storage.bucket.Bucket.blob:
-    """Uploads a file to the bucket."""
+    """Uploads a file to the bucket.
+
+    With `if_generation_match` the upload fails with `PreconditionFailed` if the
+    blob has changed since that generation was read (0: blob must not exist).
+    """
 
     # The ID of your GCS bucket
     # bucket_name = "your-bucket-name"
@@ -21,7 +30,7 @@ def upload_blob_from_memory(
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(destination_blob_name)
 
-    blob.upload_from_string(contents)
+    blob.upload_from_string(contents, if_generation_match=if_generation_match)
 
     # print(
     #     f"{destination_blob_name} with contents {contents} uploaded to {bucket_name}."
@@ -50,3 +59,37 @@ def upload_blob_from_file(
     # print(f"File {source_file_name} uploaded to {destination_blob_name}.")
 
     return blob
+
+
+def copy_blob(
+    bucket_name, blob_name, destination_blob_name
+) -> storage.bucket.Bucket.blob:
+    """Copies a blob within the same bucket, without downloading it."""
+    # The ID of your GCS bucket
+    # bucket_name = "your-bucket-name"
+    # The ID of your GCS object
+    # blob_name = "your-object-name"
+    # The ID of the copy
+    # destination_blob_name = "destination-object-name"
+
+    storage_client = storage.Client()
+    bucket = storage_client.bucket(bucket_name)
+    source_blob = bucket.blob(blob_name)
+
+    blob = bucket.copy_blob(source_blob, bucket, destination_blob_name)
+
+    return blob
+
+
+def delete_blob(bucket_name, blob_name):
+    """Deletes a blob from the bucket."""
+    # The ID of your GCS bucket
+    # bucket_name = "your-bucket-name"
+    # The ID of your GCS object
+    # blob_name = "your-object-name"
+
+    storage_client = storage.Client()
+    bucket = storage_client.bucket(bucket_name)
+    blob = bucket.blob(blob_name)
+
+    blob.delete()
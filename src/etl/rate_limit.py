@@ -0,0 +1,248 @@
+""" Collection of Rate limit and Retry functions for the Archive API """
+
+import datetime
+import email.utils
+import json
+import random
+import threading
+import time
+from typing import Callable, Optional
+
+from google.api_core.exceptions import PreconditionFailed
+from google.cloud import storage
+from pydantic import BaseModel
+
+# Status codes worth retrying, everything else (e.g. 401, 404) fails immediately
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Rate limit headers returned by the API gateway in front of the Archive API
+REMAINING_DAY_HEADER = "X-RateLimit-Remaining-Day"
+REMAINING_MINUTE_HEADER = "X-RateLimit-Remaining-Minute"
+LIMIT_DAY_HEADER = "X-RateLimit-Limit-Day"
+
+# Serializes state updates of concurrently running month requests in one process
+_state_lock = threading.Lock()
+
+
+class RateLimitExceeded(Exception):
+    """Raised when the daily request quota is used up"""
+
+
+class RateLimitState(BaseModel):
+    date: str  # UTC date the counters belong to
+    daily_quota: int
+    requests_made = 0
+    remaining_day: Optional[int] = None
+    remaining_minute: Optional[int] = None
+    next_request_at = 0.0  # Unix timestamp of the earliest allowed request
+
+    @property
+    def remaining_quota(self) -> int:
+        """Remaining requests for today, preferring what the API reported"""
+        if self.remaining_day is not None:
+            return self.remaining_day
+        return max(self.daily_quota - self.requests_made, 0)
+
+
+def utc_today() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a 'Retry-After' header given either as seconds or as HTTP date"""
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    return max((retry_at - now).total_seconds(), 0.0)
+
+
+def parse_int_header(headers, name: str) -> Optional[int]:
+    try:
+        return int(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def compute_backoff_delay(
+    attempt: int,
+    base_seconds: float,
+    max_seconds: float,
+    retry_after: Optional[float] = None,
+) -> float:
+    """Exponential backoff with equal jitter, never shorter than 'Retry-After'
+
+    Half of the delay is fixed and half is random, so concurrent retries spread
+    out but never retry immediately.
+    """
+    ceiling = min(max_seconds, base_seconds * 2**attempt)
+    delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+
+    return delay
+
+
+def load_rate_limit_state(
+    bucket_name: str, blob_name: str, daily_quota: int
+) -> tuple[RateLimitState, int]:
+    """Load state from bucket, returns state and blob generation (0 if missing)"""
+    storage_client = storage.Client()
+    bucket = storage_client.bucket(bucket_name)
+
+    # Unlike `Bucket.blob`, `Bucket.get_blob` retrieves metadata incl. generation
+    blob = bucket.get_blob(blob_name)
+
+    if blob is None:
+        return RateLimitState(date=utc_today(), daily_quota=daily_quota), 0
+
+    state = RateLimitState(**json.loads(blob.download_as_string()))
+
+    # Counters reset with a new (UTC) day
+    if state.date != utc_today():
+        state = RateLimitState(
+            date=utc_today(),
+            daily_quota=daily_quota,
+            next_request_at=state.next_request_at,
+        )
+
+    return state, blob.generation
+
+
+def update_rate_limit_state(
+    bucket_name: str,
+    blob_name: str,
+    daily_quota: int,
+    update: Callable[[RateLimitState], RateLimitState],
+    max_conflicts: int = 10,
+) -> RateLimitState:
+    """Read-modify-write the persisted state.
+
+    Writes are conditional on the blob generation that was read, so separate
+    flow runs sharing the bucket never overwrite each others counters.
+    """
+    storage_client = storage.Client()
+    bucket = storage_client.bucket(bucket_name)
+
+    with _state_lock:
+        for _ in range(max_conflicts):
+            state, generation = load_rate_limit_state(
+                bucket_name=bucket_name, blob_name=blob_name, daily_quota=daily_quota
+            )
+            state = update(state)
+
+            blob = bucket.blob(blob_name)
+            try:
+                blob.upload_from_string(
+                    state.json(),
+                    content_type="application/json",
+                    if_generation_match=generation,
+                )
+                return state
+            except PreconditionFailed:
+                # Another flow run updated the state in between, read again
+                time.sleep(random.uniform(0.1, 1.0))
+
+    raise RuntimeError(
+        f"Could not update rate limit state '{blob_name}' in bucket '{bucket_name}' after {max_conflicts} attempts"
+    )
+
+
+def reserve_slot(
+    state: RateLimitState, min_interval_seconds: float, now: float
+) -> RateLimitState:
+    """Take the next free slot at or after 'now' and count it against the quota"""
+    if state.remaining_quota <= 0:
+        raise RateLimitExceeded(
+            f"Daily quota of {state.daily_quota} requests is used up for {state.date}"
+        )
+
+    slot = max(now, state.next_request_at)
+    state.next_request_at = slot + min_interval_seconds
+    state.requests_made += 1
+    if state.remaining_day is not None:
+        state.remaining_day -= 1
+
+    return state
+
+
+def reserve_request_slot(
+    bucket_name: str,
+    blob_name: str,
+    daily_quota: int,
+    min_interval_seconds: float,
+) -> tuple[RateLimitState, float]:
+    """Reserve the next request slot, returns state and seconds to wait for it"""
+
+    state = update_rate_limit_state(
+        bucket_name=bucket_name,
+        blob_name=blob_name,
+        daily_quota=daily_quota,
+        update=lambda state: reserve_slot(
+            state=state, min_interval_seconds=min_interval_seconds, now=time.time()
+        ),
+    )
+    wait_seconds = max(state.next_request_at - min_interval_seconds - time.time(), 0)
+
+    return state, wait_seconds
+
+
+def record_rate_limit_headers(
+    bucket_name: str,
+    blob_name: str,
+    daily_quota: int,
+    headers,
+    retry_after: Optional[float] = None,
+) -> RateLimitState:
+    """Store quota reported by the API and push back all requests on 'Retry-After'"""
+
+    def record(state: RateLimitState) -> RateLimitState:
+        remaining_day = parse_int_header(headers, REMAINING_DAY_HEADER)
+        if remaining_day is not None:
+            state.remaining_day = remaining_day
+
+        remaining_minute = parse_int_header(headers, REMAINING_MINUTE_HEADER)
+        if remaining_minute is not None:
+            state.remaining_minute = remaining_minute
+
+        limit_day = parse_int_header(headers, LIMIT_DAY_HEADER)
+        if limit_day is not None:
+            state.daily_quota = limit_day
+
+        if retry_after is not None:
+            state.next_request_at = max(
+                state.next_request_at, time.time() + retry_after
+            )
+
+        return state
+
+    return update_rate_limit_state(
+        bucket_name=bucket_name,
+        blob_name=blob_name,
+        daily_quota=daily_quota,
+        update=record,
+    )
+
+
+def rate_limit_metrics(state: RateLimitState) -> dict:
+    return {
+        "date": state.date,
+        "daily_quota": state.daily_quota,
+        "requests_made": state.requests_made,
+        "remaining_quota": state.remaining_quota,
+        "remaining_minute": state.remaining_minute,
+    }
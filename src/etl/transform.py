@@ -0,0 +1,131 @@
+""" Collection of Transform functions """
+
+import pyarrow
+from pyarrow import types
+
+
+def merge_types(left: pyarrow.DataType, right: pyarrow.DataType) -> pyarrow.DataType:
+    """Merge two types into one both can be converted to.
+
+    `pyarrow.json.read_json` infers the null type for fields that are null in
+    every row of a file, so the same field can be e.g. `null` in one month and
+    `string` in another, also deep inside structs and lists.
+    """
+    if left.equals(right):
+        return left
+    if types.is_null(left):
+        return right
+    if types.is_null(right):
+        return left
+
+    if types.is_struct(left) and types.is_struct(right):
+        right_fields = {field.name: field for field in right}
+        fields = []
+        for field in left:
+            if field.name in right_fields:
+                field = pyarrow.field(
+                    field.name,
+                    merge_types(field.type, right_fields.pop(field.name).type),
+                )
+            fields.append(field)
+        # Fields only present on the right are appended in their original order
+        fields.extend(field for field in right if field.name in right_fields)
+        return pyarrow.struct(fields)
+
+    if types.is_list(left) and types.is_list(right):
+        return pyarrow.list_(merge_types(left.value_type, right.value_type))
+
+    if types.is_integer(left) and types.is_integer(right):
+        return pyarrow.int64()
+    if (types.is_integer(left) or types.is_floating(left)) and (
+        types.is_integer(right) or types.is_floating(right)
+    ):
+        return pyarrow.float64()
+
+    # Nested types can't be cast to strings, so only primitive types are widened
+    if (types.is_string(left) or types.is_string(right)) and not (
+        types.is_nested(left) or types.is_nested(right)
+    ):
+        return pyarrow.string()
+
+    raise TypeError(f"Can not merge types '{left}' and '{right}'")
+
+
+def unify_schemas(schemas: list[pyarrow.Schema]) -> pyarrow.Schema:
+    """Merge schemas field by field, fields keep the order they first appear in"""
+    merged_types = {}
+
+    for schema in schemas:
+        for field in schema:
+            if field.name in merged_types:
+                merged_types[field.name] = merge_types(
+                    merged_types[field.name], field.type
+                )
+            else:
+                merged_types[field.name] = field.type
+
+    return pyarrow.schema(
+        [pyarrow.field(name, type_) for name, type_ in merged_types.items()]
+    )
+
+
+def conform_array(array: pyarrow.Array, target_type: pyarrow.DataType) -> pyarrow.Array:
+    """Convert an array to a type created by `merge_types`.
+
+    `Array.cast` in pyarrow 12 can not add fields to structs or convert nested
+    null types, so structs and lists are rebuilt from their converted children.
+    """
+    if array.type.equals(target_type):
+        return array
+
+    if types.is_null(array.type):
+        return pyarrow.nulls(len(array), type=target_type)
+
+    if types.is_struct(target_type):
+        children = [
+            conform_array(array.field(field.name), field.type)
+            if array.type.get_field_index(field.name) != -1
+            else pyarrow.nulls(len(array), type=field.type)
+            for field in target_type
+        ]
+        return pyarrow.StructArray.from_arrays(
+            children, fields=list(target_type), mask=array.is_null()
+        )
+
+    if types.is_list(target_type):
+        # Offsets of a sliced array still point into the unsliced values, rebase
+        # both as `ListArray.from_arrays` doesn't accept sliced offsets with a mask
+        offsets = array.offsets.to_numpy()
+        length = offsets[-1] - offsets[0]
+        if types.is_null(array.type.value_type):
+            # The json reader doesn't always size null children to the offsets
+            values = pyarrow.nulls(length)
+        else:
+            values = array.values.slice(offsets[0], length)
+        return pyarrow.ListArray.from_arrays(
+            pyarrow.array(offsets - offsets[0], type=pyarrow.int32()),
+            conform_array(values, target_type.value_type),
+            type=target_type,
+            mask=array.is_null(),
+        )
+
+    return array.cast(target_type)
+
+
+def conform_table(table: pyarrow.Table, schema: pyarrow.Schema) -> pyarrow.Table:
+    """Convert a table to a schema created by `unify_schemas`, adding missing columns"""
+    columns = []
+
+    for field in schema:
+        if field.name in table.column_names:
+            column = table.column(field.name)
+            columns.append(
+                pyarrow.chunked_array(
+                    [conform_array(chunk, field.type) for chunk in column.chunks],
+                    type=field.type,
+                )
+            )
+        else:
+            columns.append(pyarrow.nulls(table.num_rows, type=field.type))
+
+    return pyarrow.Table.from_arrays(columns, schema=schema)
@@ -0,0 +1,645 @@
+""" Compact monthly Google Cloud Storage Parquet files into yearly files and swap Bigquery source URIs """
+
+import base64
+import datetime
+import io
+import json
+import re
+from typing import Optional
+
+import pyarrow
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+from prefect import flow, get_run_logger, task
+from prefect_gcp import GcpCredentials
+from pyarrow import ipc, parquet
+
+from src.config import CompactInterimArticleDataParams
+from src.etl.extract import (
+    blob_exists,
+    download_blob_into_memory,
+    download_blob_with_generation,
+    download_parquet_schema,
+    list_blob_names,
+)
+from src.etl.load import copy_blob, delete_blob, upload_blob_from_memory
+from src.etl.transform import conform_table, unify_schemas
+
+MONTHLY_BLOB_NAME_PATTERN = re.compile(
+    r"^interim_article_data_(?P<year>\d{4})_(?P<month_num>\d{1,2})\.parquet$"
+)
+
+
+def parse_monthly_blob_name(
+    blob_name: str, prefix: str = ""
+) -> Optional[tuple[int, int]]:
+    """Parse year and month of 'interim_article_data_{year}_{month_num}.parquet'"""
+    if not blob_name.startswith(prefix):
+        return None
+
+    match = MONTHLY_BLOB_NAME_PATTERN.match(blob_name[len(prefix) :])
+    if not match:
+        return None
+
+    return int(match.group("year")), int(match.group("month_num"))
+
+
+def group_monthly_blob_names_by_year(
+    blob_names: list[str], prefix: str = ""
+) -> dict[int, list[str]]:
+    """Group 'interim_article_data_{year}_{month_num}.parquet' blob names by year"""
+    blob_names_by_year = {}
+
+    for blob_name in blob_names:
+        year_month = parse_monthly_blob_name(blob_name, prefix=prefix)
+        if year_month:
+            blob_names_by_year.setdefault(year_month[0], []).append(blob_name)
+
+    return blob_names_by_year
+
+
+def split_newest_monthly_blob_name(
+    blob_names_by_year: dict[int, list[str]]
+) -> tuple[Optional[str], dict[int, list[str]]]:
+    """Split off the newest month, the other months are returned grouped by year"""
+    blob_names = [name for names in blob_names_by_year.values() for name in names]
+    if not blob_names:
+        return None, {}
+
+    newest_blob_name = max(blob_names, key=parse_monthly_blob_name)
+    remaining_blob_names = [name for name in blob_names if name != newest_blob_name]
+
+    return newest_blob_name, group_monthly_blob_names_by_year(remaining_blob_names)
+
+
+def select_expired_compacted_data(
+    compacted_blob_names: list[str],
+    files: dict[str, str],
+    superseded_files: dict[str, str],
+    referenced_blob_names: set[str],
+    now: datetime.datetime,
+    retention: datetime.timedelta,
+) -> tuple[dict[str, str], list[str]]:
+    """Track compacted files no longer in use and select those past the retention.
+
+    Files neither in the manifest nor read by the Bigquery table (e.g. left by a
+    failed run) count as superseded from now on. Files are only deleted once
+    they have been superseded for longer than the retention, so queries that
+    started before a swap can still read them.
+    """
+    superseded_files = dict(superseded_files)
+
+    for blob_name in compacted_blob_names:
+        if (
+            blob_name not in files.values()
+            and blob_name not in referenced_blob_names
+            and blob_name not in superseded_files
+        ):
+            superseded_files[blob_name] = now.isoformat()
+
+    expired_blob_names = [
+        blob_name
+        for blob_name, superseded_at in superseded_files.items()
+        if blob_name not in referenced_blob_names
+        and blob_name not in files.values()
+        and now - datetime.datetime.fromisoformat(superseded_at) > retention
+    ]
+    for blob_name in expired_blob_names:
+        del superseded_files[blob_name]
+
+    return superseded_files, expired_blob_names
+
+
+def compacted_source_uris(
+    bucket_name: str, files: dict[str, str], newest_blob_name: Optional[str]
+) -> list[str]:
+    """Source URIs of the yearly files plus the wildcard for uncompacted months.
+
+    Bigquery fails on wildcards matching no file, so the wildcard is only
+    added while a monthly file is kept uncompacted.
+    """
+    source_uris = [
+        f"gs://{bucket_name}/{blob_name}" for _, blob_name in sorted(files.items())
+    ]
+    if newest_blob_name is not None:
+        source_uris.append(f"gs://{bucket_name}/interim_article_data_*.parquet")
+
+    return source_uris
+
+
+def serialize_schema(schema: pyarrow.Schema) -> str:
+    return base64.b64encode(schema.serialize().to_pybytes()).decode()
+
+
+def deserialize_schema(serialized_schema: str) -> pyarrow.Schema:
+    return ipc.read_schema(pyarrow.py_buffer(base64.b64decode(serialized_schema)))
+
+
+@task(
+    retries=3,
+    retry_delay_seconds=3,
+)
+def list_uncompacted_interim_article_data(bucket_name: str) -> dict[int, list[str]]:
+    logger = get_run_logger()
+
+    blob_names = list_blob_names(
+        bucket_name=bucket_name, prefix="interim_article_data_"
+    )
+    blob_names_by_year = group_monthly_blob_names_by_year(blob_names)
+
+    logger.info(
+        f"Found {sum(len(names) for names in blob_names_by_year.values())} uncompacted Blobs for years {sorted(blob_names_by_year)} in bucket '{bucket_name}'"
+    )
+
+    return blob_names_by_year
+
+
+@task(
+    retries=3,
+    retry_delay_seconds=3,
+)
+def list_archived_interim_article_data(
+    bucket_name: str, archive_prefix: str, year: int
+) -> list[str]:
+    blob_names = list_blob_names(
+        bucket_name=bucket_name,
+        prefix=f"{archive_prefix}/interim_article_data_{year}_",
+    )
+
+    return group_monthly_blob_names_by_year(
+        blob_names, prefix=f"{archive_prefix}/"
+    ).get(year, [])
+
+
+@task(
+    retries=3,
+    retry_delay_seconds=3,
+)
+def list_compacted_interim_article_data(
+    bucket_name: str, compacted_prefix: str
+) -> list[str]:
+    return list_blob_names(bucket_name=bucket_name, prefix=f"{compacted_prefix}/")
+
+
+@task(
+    retries=3,
+    retry_delay_seconds=3,
+)
+def load_manifest(bucket_name: str, manifest_blob_name: str) -> tuple[dict, int]:
+    """Load manifest and its generation, the generation is 0 if it doesn't exist yet"""
+    logger = get_run_logger()
+
+    contents, generation = download_blob_with_generation(
+        bucket_name=bucket_name, blob_name=manifest_blob_name
+    )
+
+    if contents is None:
+        logger.info(f"No manifest '{manifest_blob_name}' in bucket '{bucket_name}'")
+        return {
+            "version": None,
+            "files": {},
+            "schema": None,
+            "superseded_files": {},
+        }, generation
+
+    manifest = json.loads(contents)
+    logger.info(f"Loaded manifest version '{manifest['version']}'")
+
+    return manifest, generation
+
+
+@task(
+    retries=3,
+    retry_delay_seconds=3,
+)
+def read_interim_article_data_schema(
+    bucket_name: str, source_blob_names: list[str]
+) -> pyarrow.Schema:
+    logger = get_run_logger()
+
+    schemas = [
+        download_parquet_schema(bucket_name=bucket_name, blob_name=source_blob_name)
+        for source_blob_name in sorted(source_blob_names)
+    ]
+
+    schema = unify_schemas(schemas)
+    logger.info(
+        f"Unified schema of {len(source_blob_names)} Blobs in bucket '{bucket_name}'"
+    )
+
+    return schema
+
+
+@task(
+    retries=0,
+    retry_delay_seconds=3,
+)
+def compact_yearly_interim_article_data(
+    bucket_name: str,
+    source_blob_names: list[str],
+    destination_blob_name: str,
+    schema: pyarrow.Schema,
+    target_row_group_size: int,
+) -> str:
+    logger = get_run_logger()
+
+    tables = []
+    for source_blob_name in sorted(source_blob_names):
+        contents = download_blob_into_memory(
+            bucket_name=bucket_name, blob_name=source_blob_name
+        )
+        table = parquet.read_table(pyarrow.BufferReader(contents))
+        # Every month is converted to the schema shared by all yearly files
+        tables.append(conform_table(table, schema))
+
+    table = pyarrow.concat_tables(tables).combine_chunks()
+
+    # Sorted data gives tight min/max statistics per row group on 'pub_date'
+    if "pub_date" in table.column_names:
+        table = table.sort_by("pub_date")
+
+    buffer = io.BytesIO()
+    parquet.write_table(
+        table,
+        buffer,
+        row_group_size=target_row_group_size,
+        compression="snappy",
+        write_statistics=True,
+    )
+
+    upload_blob_from_memory(
+        bucket_name=bucket_name,
+        contents=buffer.getvalue(),
+        destination_blob_name=destination_blob_name,
+    )
+
+    logger.info(
+        f"Compacted {len(source_blob_names)} Blobs with {table.num_rows} rows into Blob '{destination_blob_name}' in bucket '{bucket_name}'"
+    )
+
+    return destination_blob_name
+
+
+@task(
+    retries=0,
+    retry_delay_seconds=3,
+)
+def write_manifest(
+    bucket_name: str, manifest_blob_name: str, manifest: dict, generation: int
+) -> int:
+    """Write manifest and return its new generation"""
+    logger = get_run_logger()
+
+    # Fails if another compaction run changed the manifest since it has been loaded
+    blob = upload_blob_from_memory(
+        bucket_name=bucket_name,
+        contents=json.dumps(manifest, indent=2),
+        destination_blob_name=manifest_blob_name,
+        if_generation_match=generation,
+    )
+
+    logger.info(
+        f"Wrote manifest '{manifest_blob_name}' for version '{manifest['version']}'"
+    )
+
+    return blob.generation
+
+
+@task(
+    retries=3,
+    retry_delay_seconds=3,
+)
+def get_bigquery_source_uris(
+    project_id: str, dataset_id: str, table_id: str
+) -> list[str]:
+    client = bigquery.Client(location="eu")
+
+    dataset_reference = bigquery.DatasetReference(
+        project=project_id,
+        dataset_id=dataset_id,
+    )
+
+    table_reference = bigquery.TableReference(
+        dataset_ref=dataset_reference, table_id=table_id
+    )
+
+    table = client.get_table(table_reference)
+
+    return list(table.external_data_configuration.source_uris)
+
+
+@task(
+    retries=3,
+    retry_delay_seconds=3,
+)
+def update_bigquery_source_uris(
+    project_id: str, dataset_id: str, table_id: str, source_uris: list[str]
+):
+    logger = get_run_logger()
+
+    client = bigquery.Client(location="eu")
+
+    dataset_reference = bigquery.DatasetReference(
+        project=project_id,
+        dataset_id=dataset_id,
+    )
+
+    table_reference = bigquery.TableReference(
+        dataset_ref=dataset_reference, table_id=table_id
+    )
+
+    table = client.get_table(table_reference)
+
+    external_config = table.external_data_configuration
+    external_config.source_uris = source_uris
+    table.external_data_configuration = external_config
+
+    # Metadata update is atomic, queries see either the old or new source URIs
+    table = client.update_table(table, ["external_data_configuration"])
+    logger.info(f"Updated source URIs of Bigquery table '{table}' to {source_uris}")
+
+
+@task(
+    retries=3,
+    retry_delay_seconds=3,
+)
+def archive_interim_article_data(
+    bucket_name: str, blob_names: list[str], archive_prefix: str
+):
+    logger = get_run_logger()
+
+    for blob_name in blob_names:
+        archived_blob_name = f"{archive_prefix}/{blob_name}"
+        try:
+            copy_blob(
+                bucket_name=bucket_name,
+                blob_name=blob_name,
+                destination_blob_name=archived_blob_name,
+            )
+        except NotFound:
+            # Already moved by an earlier attempt of this task
+            if blob_exists(bucket_name=bucket_name, blob_name=archived_blob_name):
+                continue
+            raise
+
+        try:
+            delete_blob(bucket_name=bucket_name, blob_name=blob_name)
+        except NotFound:
+            pass
+
+    logger.info(
+        f"Moved {len(blob_names)} Blobs to '{archive_prefix}/' in bucket '{bucket_name}'"
+    )
+
+
+@task(
+    retries=3,
+    retry_delay_seconds=3,
+)
+def delete_superseded_compacted_data(bucket_name: str, blob_names: list[str]):
+    logger = get_run_logger()
+
+    for blob_name in blob_names:
+        try:
+            delete_blob(bucket_name=bucket_name, blob_name=blob_name)
+        except NotFound:
+            # Already deleted by an earlier run that failed to update the manifest
+            logger.info(f"Blob '{blob_name}' does not exist anymore")
+
+    logger.info(f"Deleted {len(blob_names)} superseded Blobs in bucket '{bucket_name}'")
+
+
+@flow
+def compact_interim_article_data(params: CompactInterimArticleDataParams):
+    logger = get_run_logger()
+
+    gcp_credentials = GcpCredentials.load("ny-times-prefect-sa")
+    bucket_name = params.interim_data_bucket_name
+    table_kwargs = dict(
+        project_id=gcp_credentials.project,
+        dataset_id=params.dataset_id,
+        table_id=params.table_id,
+    )
+
+    manifest, generation = load_manifest(
+        bucket_name=bucket_name, manifest_blob_name=params.manifest_blob_name
+    )
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    # A pending version marks a run that is swapping the source URIs right now
+    pending = manifest.pop("pending", None)
+    if pending is not None:
+        started_at = datetime.datetime.fromisoformat(pending["started_at"])
+        if now - started_at < datetime.timedelta(hours=params.pending_timeout_hours):
+            raise RuntimeError(
+                f"Compaction of version '{pending['version']}' started at {started_at} is still in progress"
+            )
+
+        logger.warning(
+            f"Compaction of version '{pending['version']}' did not finish, restoring its previous source URIs"
+        )
+        update_bigquery_source_uris(
+            **table_kwargs, source_uris=pending["previous_source_uris"]
+        )
+
+    # Clean up files superseded by earlier runs, before this run supersedes more
+    source_uris = get_bigquery_source_uris(**table_kwargs)
+    previous_superseded_files = manifest.get("superseded_files", {})
+    superseded_files, expired_blob_names = select_expired_compacted_data(
+        compacted_blob_names=list_compacted_interim_article_data(
+            bucket_name=bucket_name, compacted_prefix=params.compacted_prefix
+        ),
+        files=manifest["files"],
+        superseded_files=previous_superseded_files,
+        referenced_blob_names={
+            source_uri[len(f"gs://{bucket_name}/") :] for source_uri in source_uris
+        },
+        now=now,
+        retention=datetime.timedelta(hours=params.superseded_retention_hours),
+    )
+    delete_superseded_compacted_data(
+        bucket_name=bucket_name, blob_names=expired_blob_names
+    )
+    manifest["superseded_files"] = superseded_files
+
+    # The newest month is never compacted, so the monthly wildcard always matches
+    # a file and months ingested later show up in Bigquery right away
+    newest_blob_name, uncompacted_blob_names_by_year = split_newest_monthly_blob_name(
+        list_uncompacted_interim_article_data(bucket_name=bucket_name)
+    )
+
+    if not uncompacted_blob_names_by_year:
+        # Finish a run that failed after its swap, e.g. while archiving
+        final_source_uris = compacted_source_uris(
+            bucket_name=bucket_name,
+            files=manifest["files"],
+            newest_blob_name=newest_blob_name,
+        )
+        if final_source_uris and source_uris != final_source_uris:
+            # Claimed like a compaction swap, so concurrent runs don't interleave
+            generation = write_manifest(
+                bucket_name=bucket_name,
+                manifest_blob_name=params.manifest_blob_name,
+                manifest={
+                    **manifest,
+                    "pending": {
+                        "version": manifest["version"],
+                        "started_at": now.isoformat(),
+                        "previous_source_uris": source_uris,
+                    },
+                },
+                generation=generation,
+            )
+            update_bigquery_source_uris(**table_kwargs, source_uris=final_source_uris)
+            write_manifest(
+                bucket_name=bucket_name,
+                manifest_blob_name=params.manifest_blob_name,
+                manifest=manifest,
+                generation=generation,
+            )
+        elif pending is not None or superseded_files != previous_superseded_files:
+            write_manifest(
+                bucket_name=bucket_name,
+                manifest_blob_name=params.manifest_blob_name,
+                manifest=manifest,
+                generation=generation,
+            )
+
+        logger.info("Nothing to compact")
+        return
+
+    version = now.strftime("%Y%m%dT%H%M%S")
+    files = dict(manifest["files"])
+    uncompacted_blob_names = [
+        blob_name
+        for blob_names in uncompacted_blob_names_by_year.values()
+        for blob_name in blob_names
+    ]
+
+    # The stored schema already covers every archived month, so only new months are read
+    previous_schema = (
+        deserialize_schema(manifest["schema"]) if manifest.get("schema") else None
+    )
+    if previous_schema is None:
+        schema = None
+        years = set(uncompacted_blob_names_by_year) | {int(year) for year in files}
+    else:
+        schema = unify_schemas(
+            [
+                previous_schema,
+                read_interim_article_data_schema(
+                    bucket_name=bucket_name, source_blob_names=uncompacted_blob_names
+                ),
+            ]
+        )
+        if schema.equals(previous_schema):
+            # Only years with new monthly files are rewritten
+            years = set(uncompacted_blob_names_by_year)
+        else:
+            # A widened schema would make the existing yearly files inconsistent
+            years = set(uncompacted_blob_names_by_year) | {int(year) for year in files}
+
+    source_blob_names_by_year = {}
+    for year in sorted(years):
+        blob_names = uncompacted_blob_names_by_year.get(year, [])
+        archived_blob_names = list_archived_interim_article_data(
+            bucket_name=bucket_name, archive_prefix=params.archive_prefix, year=year
+        )
+        # Freshly ingested months replace their archived version
+        source_blob_names_by_year[year] = blob_names + [
+            archived_blob_name
+            for archived_blob_name in archived_blob_names
+            if archived_blob_name[len(params.archive_prefix) + 1 :] not in blob_names
+        ]
+
+    if schema is None:
+        schema = read_interim_article_data_schema(
+            bucket_name=bucket_name,
+            source_blob_names=[
+                blob_name
+                for blob_names in source_blob_names_by_year.values()
+                for blob_name in blob_names
+            ],
+        )
+
+    # Each year is rebuilt from all of its months
+    for year, source_blob_names in source_blob_names_by_year.items():
+        files[str(year)] = compact_yearly_interim_article_data(
+            bucket_name=bucket_name,
+            source_blob_names=source_blob_names,
+            destination_blob_name=f"{params.compacted_prefix}/{version}/interim_article_data_{year}.parquet",
+            schema=schema,
+            target_row_group_size=params.target_row_group_size,
+        )
+
+    # Claim the swap before touching Bigquery, fails if another run got there first
+    generation = write_manifest(
+        bucket_name=bucket_name,
+        manifest_blob_name=params.manifest_blob_name,
+        manifest={
+            **manifest,
+            "pending": {
+                "version": version,
+                "started_at": now.isoformat(),
+                "previous_source_uris": source_uris,
+            },
+        },
+        generation=generation,
+    )
+
+    try:
+        # Swap to the compacted files plus the newest month only, so no month is
+        # read twice while its monthly file is moved to the archive
+        update_bigquery_source_uris(
+            **table_kwargs,
+            source_uris=compacted_source_uris(
+                bucket_name=bucket_name, files=files, newest_blob_name=None
+            )
+            + [f"gs://{bucket_name}/{newest_blob_name}"],
+        )
+
+        # Retention starts with the swap, queries started before may still read them
+        swapped_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        superseded_files = dict(manifest["superseded_files"])
+        for year, blob_name in manifest["files"].items():
+            if files[year] != blob_name:
+                superseded_files[blob_name] = swapped_at
+
+        write_manifest(
+            bucket_name=bucket_name,
+            manifest_blob_name=params.manifest_blob_name,
+            manifest={
+                "version": version,
+                "files": files,
+                "schema": serialize_schema(schema),
+                "superseded_files": superseded_files,
+            },
+            generation=generation,
+        )
+    except Exception as e:
+        logger.error(f"Swap to version '{version}' failed, restoring source URIs: {e}")
+        update_bigquery_source_uris(**table_kwargs, source_uris=source_uris)
+        write_manifest(
+            bucket_name=bucket_name,
+            manifest_blob_name=params.manifest_blob_name,
+            manifest=manifest,
+            generation=generation,
+        )
+        raise
+
+    archive_interim_article_data(
+        bucket_name=bucket_name,
+        blob_names=uncompacted_blob_names,
+        archive_prefix=params.archive_prefix,
+    )
+
+    update_bigquery_source_uris(
+        **table_kwargs,
+        source_uris=compacted_source_uris(
+            bucket_name=bucket_name, files=files, newest_blob_name=newest_blob_name
+        ),
+    )
+
+
+if __name__ == "__main__":
+    compact_interim_article_data(params=CompactInterimArticleDataParams())
@@ -2,26 +2,49 @@
 
 import json
 import pathlib
+import time
 
 import requests
 from prefect import flow, get_run_logger, task
+from prefect.artifacts import create_table_artifact
 from prefect.blocks.system import Secret
 
 from src.config import IngestRawArticleDataParams
 from src.etl.load import upload_blob_from_file
+from src.etl.rate_limit import (
+    RETRYABLE_STATUS_CODES,
+    RateLimitState,
+    compute_backoff_delay,
+    parse_retry_after,
+    rate_limit_metrics,
+    record_rate_limit_headers,
+    reserve_request_slot,
+)
 from src.utils import convert_to_jsonl, rmtree
 
 
 @task(
-    retries=3,
-    retry_delay_seconds=15,  # 12 second delay is recommended according to API developer documentation
+    retries=0,  # Retries are handled inside the task based on the rate limit headers
     name="Request Archive API (https://api.nytimes.com/svc/archive)",
 )
 def request_archive_api(
-    year: int, month_num: int, api_key: str, version: int = 1
+    year: int,
+    month_num: int,
+    api_key: str,
+    rate_limit_bucket_name: str,
+    rate_limit_state_blob_name: str,
+    daily_request_quota: int,
+    min_request_interval_seconds: float,
+    max_retries: int,
+    backoff_base_seconds: float,
+    backoff_max_seconds: float,
+    version: int = 1,
 ) -> dict:
     logger = get_run_logger()
 
+    if max_retries < 0:
+        raise ValueError(f"'max_retries' must be 0 or greater, got {max_retries}")
+
     api_url_pattern = "https://api.nytimes.com/svc/archive/v{version}/{year}/{month_num}.json?api-key={api_key}"
     api_url = api_url_pattern.format(
         version=version, year=year, month_num=month_num, api_key=api_key
@@ -29,28 +52,83 @@ def request_archive_api(
     logger.info(f"Constructed the following endpoint url: {api_url}")
     query_params = {}
 
-    try:
-        logger.info(f"Requesting data from '{api_url}' using params '{query_params}'")
-        r = requests.get(url=api_url, params=query_params)
-
-        headers = r.headers
-        logger.info(f"Received response with following header: {headers}")
-
-        r.raise_for_status()
+    rate_limit_kwargs = dict(
+        bucket_name=rate_limit_bucket_name,
+        blob_name=rate_limit_state_blob_name,
+        daily_quota=daily_request_quota,
+    )
 
-        data = r.json()["response"]["docs"]  # docs are articles
-        logger.info("Received data as JSON")
+    last_error = None
+    for attempt in range(max_retries + 1):
+        # Shared across months and flow runs, raises once the daily quota is used up
+        state, wait_seconds = reserve_request_slot(
+            **rate_limit_kwargs, min_interval_seconds=min_request_interval_seconds
+        )
+        if wait_seconds > 0:
+            logger.info(f"Waiting {wait_seconds:.1f} seconds for next request slot")
+            time.sleep(wait_seconds)
+
+        retry_after = None
+        try:
+            logger.info(
+                f"Requesting data for {year}-{month_num} (attempt {attempt + 1} of {max_retries + 1})"
+            )
+            r = requests.get(url=api_url, params=query_params, timeout=60)
+
+            headers = r.headers
+            logger.info(f"Received response with following header: {headers}")
+
+            retry_after = parse_retry_after(headers.get("Retry-After"))
+            state = record_rate_limit_headers(
+                **rate_limit_kwargs, headers=headers, retry_after=retry_after
+            )
+            log_rate_limit_metrics(state)
+
+            r.raise_for_status()
+
+            data = r.json()["response"]["docs"]  # docs are articles
+            logger.info("Received data as JSON")
+
+            return data
+
+        except requests.exceptions.HTTPError as error:
+            logger.warning(f"HTTP error occurred: {error}")
+            if error.response.status_code not in RETRYABLE_STATUS_CODES:
+                raise
+            last_error = error
+        except requests.exceptions.ConnectionError as error:
+            logger.warning(f"Connection error occurred: {error}")
+            last_error = error
+        except requests.exceptions.Timeout as error:
+            logger.warning(f"Timeout error occurred: {error}")
+            last_error = error
+
+        if attempt < max_retries:
+            delay = compute_backoff_delay(
+                attempt=attempt,
+                base_seconds=backoff_base_seconds,
+                max_seconds=backoff_max_seconds,
+                retry_after=retry_after,
+            )
+            logger.info(f"Retrying in {delay:.1f} seconds")
+            time.sleep(delay)
+
+    raise RuntimeError(
+        f"Requesting data for {year}-{month_num} failed after {max_retries + 1} attempts"
+    ) from last_error
+
+
+def log_rate_limit_metrics(state: RateLimitState):
+    logger = get_run_logger()
 
-    except requests.exceptions.HTTPError as error:
-        print(f"HTTP error occurred: {error}")
-    except requests.exceptions.ConnectionError as error:
-        print(f"Connection error occurred: {error}")
-    except requests.exceptions.Timeout as error:
-        print(f"Timeout error occurred: {error}")
-    except requests.exceptions.RequestException as error:
-        print(f"An Request error occurred: {error}")
+    metrics = rate_limit_metrics(state)
+    logger.info(f"Archive API rate limit metrics: {metrics}")
 
-    return data
+    create_table_artifact(
+        key="archive-api-rate-limit",
+        table=[metrics],
+        description="Remaining Archive API quota",
+    )
 
 
 @task(retries=3, retry_delay_seconds=3, name="Store raw article data as JSONL")
@@ -118,6 +196,8 @@ def delete_local_temp_directory_and_files(directory: pathlib.Path):
 
 @flow
 def ingest_raw_article_data(params: IngestRawArticleDataParams):
+    logger = get_run_logger()
+
     params = IngestRawArticleDataParams()
     year = params.year
     month_num = params.month_num
@@ -130,7 +210,17 @@ def ingest_raw_article_data(params: IngestRawArticleDataParams):
 
     try:
         data = request_archive_api(
-            year=year, month_num=month_num, api_key=api_key, version=api_version
+            year=year,
+            month_num=month_num,
+            api_key=api_key,
+            version=api_version,
+            rate_limit_bucket_name=raw_data_bucket_name,
+            rate_limit_state_blob_name=params.rate_limit_state_blob_name,
+            daily_request_quota=params.daily_request_quota,
+            min_request_interval_seconds=params.min_request_interval_seconds,
+            max_retries=params.max_retries,
+            backoff_base_seconds=params.backoff_base_seconds,
+            backoff_max_seconds=params.backoff_max_seconds,
         )
 
         directory = pathlib.Path.cwd() / "temp"
@@ -148,9 +238,10 @@ def ingest_raw_article_data(params: IngestRawArticleDataParams):
             month_num=month_num,
         )
     except Exception as e:
-        print(f"An exception occured: {e}")
-
-    delete_local_temp_directory_and_files(directory=directory)
+        logger.error(f"An exception occured: {e}")
+        raise
+    finally:
+        delete_local_temp_directory_and_files(directory=directory)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,40 @@
+import io
+from types import SimpleNamespace
+
+import pyarrow
+import pytest
+from pyarrow import parquet
+
+from src.etl import extract
+
+
+class FakeBlob:
+    def __init__(self, contents: bytes):
+        self.contents = contents
+        self.size = len(contents)
+        self.downloaded_bytes = 0
+
+    def download_as_bytes(self, start=0):
+        self.downloaded_bytes += self.size - start
+        return self.contents[start:]
+
+
+@pytest.mark.parametrize("footer_bytes", [64 * 1024, 16])
+def test_download_parquet_schema(monkeypatch, footer_bytes):
+    table = pyarrow.table(
+        {"id": [str(i) for i in range(100000)], "headline": [{"main": "a"}] * 100000}
+    )
+    buffer = io.BytesIO()
+    parquet.write_table(table, buffer)
+    blob = FakeBlob(buffer.getvalue())
+
+    client = SimpleNamespace(
+        bucket=lambda bucket_name: SimpleNamespace(get_blob=lambda blob_name: blob)
+    )
+    monkeypatch.setattr(extract.storage, "Client", lambda: client)
+    monkeypatch.setattr(extract, "PARQUET_FOOTER_BYTES", footer_bytes)
+
+    schema = extract.download_parquet_schema("bucket", "blob.parquet")
+
+    assert schema == table.schema
+    assert blob.downloaded_bytes < blob.size
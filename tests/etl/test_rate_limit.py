@@ -0,0 +1,85 @@
+import datetime
+import email.utils
+
+import pytest
+
+from src.etl.rate_limit import (
+    RateLimitExceeded,
+    RateLimitState,
+    compute_backoff_delay,
+    parse_retry_after,
+    reserve_slot,
+)
+
+
+def test_parse_retry_after_seconds():
+    assert parse_retry_after("120") == 120.0
+
+
+def test_parse_retry_after_http_date():
+    retry_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+        seconds=60
+    )
+    value = email.utils.format_datetime(retry_at, usegmt=True)
+
+    assert 55 <= parse_retry_after(value) <= 60
+
+
+def test_parse_retry_after_http_date_in_the_past():
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+
+
+@pytest.mark.parametrize("value", [None, "", "soon"])
+def test_parse_retry_after_invalid(value):
+    assert parse_retry_after(value) is None
+
+
+@pytest.mark.parametrize("attempt", range(10))
+def test_compute_backoff_delay_bounds(attempt):
+    delay = compute_backoff_delay(attempt=attempt, base_seconds=15, max_seconds=300)
+
+    ceiling = min(300, 15 * 2**attempt)
+    assert ceiling / 2 <= delay <= ceiling
+
+
+def test_compute_backoff_delay_is_jittered_on_first_retry():
+    delays = {
+        compute_backoff_delay(attempt=0, base_seconds=15, max_seconds=300)
+        for _ in range(20)
+    }
+
+    assert len(delays) > 1
+
+
+def test_compute_backoff_delay_respects_retry_after():
+    delay = compute_backoff_delay(
+        attempt=0, base_seconds=15, max_seconds=300, retry_after=600
+    )
+
+    assert delay == 600
+
+
+def test_reserve_slot_spaces_requests():
+    state = RateLimitState(date="2023-06-01", daily_quota=500)
+
+    state = reserve_slot(state=state, min_interval_seconds=12, now=1000.0)
+    state = reserve_slot(state=state, min_interval_seconds=12, now=1001.0)
+
+    assert state.requests_made == 2
+    assert state.next_request_at == 1024.0
+
+
+def test_reserve_slot_raises_once_quota_is_used_up():
+    state = RateLimitState(date="2023-06-01", daily_quota=1)
+
+    state = reserve_slot(state=state, min_interval_seconds=12, now=1000.0)
+
+    with pytest.raises(RateLimitExceeded):
+        reserve_slot(state=state, min_interval_seconds=12, now=1012.0)
+
+
+def test_reserve_slot_prefers_quota_reported_by_api():
+    state = RateLimitState(date="2023-06-01", daily_quota=500, remaining_day=0)
+
+    with pytest.raises(RateLimitExceeded):
+        reserve_slot(state=state, min_interval_seconds=12, now=1000.0)
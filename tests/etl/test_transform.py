@@ -0,0 +1,79 @@
+import pyarrow
+import pytest
+
+from src.etl.transform import conform_table, merge_types, unify_schemas
+
+
+def test_merge_types_nested_null():
+    left = pyarrow.struct([("main", pyarrow.string()), ("kicker", pyarrow.null())])
+    right = pyarrow.struct([("main", pyarrow.string()), ("kicker", pyarrow.string())])
+
+    assert merge_types(left, right) == right
+
+
+def test_merge_types_list_of_null():
+    right = pyarrow.list_(pyarrow.struct([("url", pyarrow.string())]))
+
+    assert merge_types(pyarrow.list_(pyarrow.null()), right) == right
+
+
+def test_merge_types_numbers():
+    assert merge_types(pyarrow.int32(), pyarrow.int64()) == pyarrow.int64()
+    assert merge_types(pyarrow.int64(), pyarrow.float64()) == pyarrow.float64()
+
+
+def test_merge_types_primitive_to_string():
+    assert merge_types(pyarrow.int64(), pyarrow.string()) == pyarrow.string()
+
+
+@pytest.mark.parametrize(
+    "left, right",
+    [
+        (pyarrow.list_(pyarrow.string()), pyarrow.int64()),
+        (pyarrow.list_(pyarrow.string()), pyarrow.string()),
+        (pyarrow.struct([("a", pyarrow.string())]), pyarrow.string()),
+        (pyarrow.string(), pyarrow.struct([("a", pyarrow.string())])),
+    ],
+)
+def test_merge_types_incompatible(left, right):
+    with pytest.raises(TypeError):
+        merge_types(left, right)
+
+
+def test_conform_table():
+    left = pyarrow.table(
+        {
+            "headline": pyarrow.array(
+                [{"main": "a", "kicker": None}, None],
+                type=pyarrow.struct(
+                    [("main", pyarrow.string()), ("kicker", pyarrow.null())]
+                ),
+            ),
+            "multimedia": pyarrow.array([[], None], type=pyarrow.list_(pyarrow.null())),
+            "word_count": pyarrow.array([1, 2], type=pyarrow.int64()),
+        }
+    )
+    right = pyarrow.table(
+        {
+            "headline": [{"main": "b", "kicker": "c", "print_headline": "d"}],
+            "multimedia": [[{"url": "e"}]],
+            "word_count": pyarrow.array([1.5], type=pyarrow.float64()),
+            "byline": [{"original": "f"}],
+        }
+    )
+    schema = unify_schemas([left.schema, right.schema])
+
+    table = pyarrow.concat_tables(
+        [conform_table(left.slice(1), schema), conform_table(right, schema)]
+    )
+
+    assert table.schema == schema
+    assert table.to_pylist() == [
+        {"headline": None, "multimedia": None, "word_count": 2.0, "byline": None},
+        {
+            "headline": {"main": "b", "kicker": "c", "print_headline": "d"},
+            "multimedia": [{"url": "e"}],
+            "word_count": 1.5,
+            "byline": {"original": "f"},
+        },
+    ]
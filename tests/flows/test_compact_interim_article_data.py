@@ -0,0 +1,448 @@
+import datetime
+import io
+import json
+from types import SimpleNamespace
+
+import pyarrow
+import pytest
+from google.api_core.exceptions import PreconditionFailed
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+from prefect import flow
+from prefect.testing.utilities import prefect_test_harness
+from pyarrow import parquet
+
+from src.config import CompactInterimArticleDataParams
+from src.flows import compact_interim_article_data as compaction
+from src.flows.compact_interim_article_data import (
+    archive_interim_article_data,
+    compact_interim_article_data,
+    compacted_source_uris,
+    group_monthly_blob_names_by_year,
+    parse_monthly_blob_name,
+    select_expired_compacted_data,
+    split_newest_monthly_blob_name,
+)
+
+BUCKET_NAME = "interim_article_data"
+WILDCARD_SOURCE_URI = f"gs://{BUCKET_NAME}/interim_article_data_*.parquet"
+
+
+class FakeStorage:
+    """In memory replacement for the Google Cloud Storage functions in `src.etl`"""
+
+    def __init__(self):
+        self.blobs = {}
+        self.generation = 0
+        self.manifest_writes = 0
+        self.failing_manifest_writes = {}  # Number of the write: exception to raise
+
+    def put(self, blob_name, contents):
+        self.generation += 1
+        self.blobs[blob_name] = (contents, self.generation)
+        return SimpleNamespace(generation=self.generation)
+
+    def list_blob_names(self, bucket_name, prefix=None):
+        return sorted(name for name in self.blobs if name.startswith(prefix or ""))
+
+    def download_blob_into_memory(self, bucket_name, blob_name):
+        return self.blobs[blob_name][0]
+
+    def download_blob_with_generation(self, bucket_name, blob_name):
+        return self.blobs.get(blob_name, (None, 0))
+
+    def download_parquet_schema(self, bucket_name, blob_name):
+        return parquet.read_schema(pyarrow.BufferReader(self.blobs[blob_name][0]))
+
+    def upload_blob_from_memory(
+        self, bucket_name, contents, destination_blob_name, if_generation_match=None
+    ):
+        if destination_blob_name == "manifest.json":
+            self.manifest_writes += 1
+            if self.manifest_writes in self.failing_manifest_writes:
+                raise self.failing_manifest_writes[self.manifest_writes]
+
+        current_generation = self.blobs.get(destination_blob_name, (None, 0))[1]
+        if (
+            if_generation_match is not None
+            and if_generation_match != current_generation
+        ):
+            raise PreconditionFailed(f"{destination_blob_name} has changed")
+
+        if isinstance(contents, str):
+            contents = contents.encode()
+        return self.put(destination_blob_name, contents)
+
+    def copy_blob(self, bucket_name, blob_name, destination_blob_name):
+        if blob_name not in self.blobs:
+            raise NotFound(blob_name)
+        return self.put(destination_blob_name, self.blobs[blob_name][0])
+
+    def delete_blob(self, bucket_name, blob_name):
+        if blob_name not in self.blobs:
+            raise NotFound(blob_name)
+        del self.blobs[blob_name]
+
+    def blob_exists(self, bucket_name, blob_name):
+        return blob_name in self.blobs
+
+    @property
+    def manifest(self):
+        return json.loads(self.blobs["manifest.json"][0])
+
+
+class FakeBigqueryClient:
+    """Replacement for `bigquery.Client`, all clients share the external table"""
+
+    source_uris = []
+    updates = []
+    failing_updates = 0
+
+    def __init__(self, location=None):
+        pass
+
+    def get_table(self, table_reference):
+        return SimpleNamespace(
+            external_data_configuration=SimpleNamespace(
+                source_uris=list(FakeBigqueryClient.source_uris)
+            )
+        )
+
+    def update_table(self, table, fields):
+        if FakeBigqueryClient.failing_updates:
+            FakeBigqueryClient.failing_updates -= 1
+            raise RuntimeError("Bigquery is unavailable")
+
+        FakeBigqueryClient.source_uris = list(
+            table.external_data_configuration.source_uris
+        )
+        FakeBigqueryClient.updates.append(FakeBigqueryClient.source_uris)
+        return table
+
+
+@pytest.fixture(scope="module")
+def prefect_harness():
+    with prefect_test_harness():
+        yield
+
+
+@pytest.fixture
+def storage(monkeypatch, prefect_harness):
+    fake_storage = FakeStorage()
+    for name in [
+        "list_blob_names",
+        "download_blob_into_memory",
+        "download_blob_with_generation",
+        "download_parquet_schema",
+        "upload_blob_from_memory",
+        "copy_blob",
+        "delete_blob",
+        "blob_exists",
+    ]:
+        monkeypatch.setattr(compaction, name, getattr(fake_storage, name))
+
+    monkeypatch.setattr(bigquery, "Client", FakeBigqueryClient)
+    FakeBigqueryClient.source_uris = [WILDCARD_SOURCE_URI]
+    FakeBigqueryClient.updates = []
+    FakeBigqueryClient.failing_updates = 0
+
+    monkeypatch.setattr(
+        compaction,
+        "GcpCredentials",
+        SimpleNamespace(load=lambda name: SimpleNamespace(project="project")),
+    )
+
+    return fake_storage
+
+
+def to_parquet(rows: list[dict]) -> bytes:
+    buffer = io.BytesIO()
+    parquet.write_table(pyarrow.Table.from_pylist(rows), buffer)
+    return buffer.getvalue()
+
+
+def add_monthly_blobs(storage: FakeStorage):
+    storage.put(
+        "interim_article_data_2019_1.parquet",
+        to_parquet(
+            [
+                {"pub_date": "2019-01-02", "headline": {"main": "b", "kicker": None}},
+                {"pub_date": "2019-01-01", "headline": {"main": "a", "kicker": None}},
+            ]
+        ),
+    )
+    storage.put(
+        "interim_article_data_2019_2.parquet",
+        to_parquet(
+            [{"pub_date": "2019-02-01", "headline": {"main": "c", "kicker": "d"}}]
+        ),
+    )
+    storage.put(
+        "interim_article_data_2020_1.parquet",
+        to_parquet(
+            [{"pub_date": "2020-01-01", "headline": {"main": "e", "kicker": None}}]
+        ),
+    )
+
+
+def test_parse_monthly_blob_name():
+    assert parse_monthly_blob_name("interim_article_data_2019_2.parquet") == (2019, 2)
+    assert parse_monthly_blob_name("interim_article_data_2019_12.parquet") == (
+        2019,
+        12,
+    )
+
+
+def test_parse_monthly_blob_name_ignores_other_blobs():
+    assert parse_monthly_blob_name("interim_article_data_2019_2.html") is None
+    assert parse_monthly_blob_name("interim_article_data_2019.parquet") is None
+    assert (
+        parse_monthly_blob_name("archive/interim_article_data_2019_2.parquet") is None
+    )
+
+
+def test_group_monthly_blob_names_by_year():
+    blob_names = [
+        "interim_article_data_2019_1.parquet",
+        "interim_article_data_2019_2.parquet",
+        "interim_article_data_2020_1.parquet",
+        "manifest.json",
+    ]
+
+    assert group_monthly_blob_names_by_year(blob_names) == {
+        2019: [
+            "interim_article_data_2019_1.parquet",
+            "interim_article_data_2019_2.parquet",
+        ],
+        2020: ["interim_article_data_2020_1.parquet"],
+    }
+
+
+def test_group_monthly_blob_names_by_year_with_prefix():
+    blob_names = [
+        "archive/interim_article_data_2019_1.parquet",
+        "interim_article_data_2019_2.parquet",
+        "compacted/20230601T000000/interim_article_data_2019.parquet",
+    ]
+
+    assert group_monthly_blob_names_by_year(blob_names, prefix="archive/") == {
+        2019: ["archive/interim_article_data_2019_1.parquet"]
+    }
+
+
+def test_split_newest_monthly_blob_name():
+    newest_blob_name, blob_names_by_year = split_newest_monthly_blob_name(
+        {
+            2019: [
+                "interim_article_data_2019_12.parquet",
+                "interim_article_data_2019_2.parquet",
+            ],
+            2020: ["interim_article_data_2020_1.parquet"],
+        }
+    )
+
+    assert newest_blob_name == "interim_article_data_2020_1.parquet"
+    assert blob_names_by_year == {
+        2019: [
+            "interim_article_data_2019_12.parquet",
+            "interim_article_data_2019_2.parquet",
+        ]
+    }
+
+
+def test_split_newest_monthly_blob_name_without_blobs():
+    assert split_newest_monthly_blob_name({}) == (None, {})
+
+
+def test_select_expired_compacted_data():
+    now = datetime.datetime(2023, 6, 2, tzinfo=datetime.timezone.utc)
+    files = {"2019": "compacted/v2/interim_article_data_2019.parquet"}
+
+    superseded_files, expired_blob_names = select_expired_compacted_data(
+        compacted_blob_names=[
+            "compacted/v1/interim_article_data_2019.parquet",
+            "compacted/v2/interim_article_data_2019.parquet",
+            "compacted/v3/interim_article_data_2019.parquet",  # Left by a failed run
+            "compacted/v4/interim_article_data_2019.parquet",  # Read by Bigquery
+        ],
+        files=files,
+        superseded_files={
+            "compacted/v0/interim_article_data_2019.parquet": "2023-05-31T00:00:00+00:00",
+            "compacted/v1/interim_article_data_2019.parquet": "2023-06-01T12:00:00+00:00",
+        },
+        referenced_blob_names={"compacted/v4/interim_article_data_2019.parquet"},
+        now=now,
+        retention=datetime.timedelta(hours=24),
+    )
+
+    assert expired_blob_names == ["compacted/v0/interim_article_data_2019.parquet"]
+    assert superseded_files == {
+        "compacted/v1/interim_article_data_2019.parquet": "2023-06-01T12:00:00+00:00",
+        "compacted/v3/interim_article_data_2019.parquet": now.isoformat(),
+    }
+
+
+def test_compacted_source_uris():
+    files = {"2020": "compacted/v1/b.parquet", "2019": "compacted/v1/a.parquet"}
+
+    assert compacted_source_uris(BUCKET_NAME, files, newest_blob_name=None) == [
+        f"gs://{BUCKET_NAME}/compacted/v1/a.parquet",
+        f"gs://{BUCKET_NAME}/compacted/v1/b.parquet",
+    ]
+    assert compacted_source_uris(BUCKET_NAME, files, "x.parquet")[-1] == (
+        WILDCARD_SOURCE_URI
+    )
+
+
+def test_compact_interim_article_data(storage):
+    add_monthly_blobs(storage)
+
+    compact_interim_article_data(params=CompactInterimArticleDataParams())
+
+    manifest = storage.manifest
+    compacted_blob_name = (
+        f"compacted/{manifest['version']}/interim_article_data_2019.parquet"
+    )
+    assert manifest["files"] == {"2019": compacted_blob_name}
+    assert "pending" not in manifest
+
+    # Swapped to the compacted year plus the newest month, then the wildcard is back
+    assert FakeBigqueryClient.updates == [
+        [
+            f"gs://{BUCKET_NAME}/{compacted_blob_name}",
+            f"gs://{BUCKET_NAME}/interim_article_data_2020_1.parquet",
+        ],
+        [f"gs://{BUCKET_NAME}/{compacted_blob_name}", WILDCARD_SOURCE_URI],
+    ]
+
+    # The newest month stays uncompacted, so the wildcard keeps matching a file
+    assert storage.list_blob_names(BUCKET_NAME, prefix="interim_article_data_") == [
+        "interim_article_data_2020_1.parquet"
+    ]
+    assert storage.list_blob_names(BUCKET_NAME, prefix="archive/") == [
+        "archive/interim_article_data_2019_1.parquet",
+        "archive/interim_article_data_2019_2.parquet",
+    ]
+
+    table = parquet.read_table(
+        pyarrow.BufferReader(storage.blobs[compacted_blob_name][0])
+    )
+    assert table.column("pub_date").to_pylist() == [
+        "2019-01-01",
+        "2019-01-02",
+        "2019-02-01",
+    ]
+    # 'kicker' is null in the first month and a string in the second one
+    headline_type = table.schema.field("headline").type
+    assert headline_type.field("kicker").type == pyarrow.string()
+
+
+def test_compact_interim_article_data_restores_source_uris_on_failure(storage):
+    add_monthly_blobs(storage)
+    # The first write claims the swap, the second one commits it
+    storage.failing_manifest_writes = {2: RuntimeError("Storage is unavailable")}
+
+    with pytest.raises(RuntimeError):
+        compact_interim_article_data(params=CompactInterimArticleDataParams())
+
+    assert FakeBigqueryClient.source_uris == [WILDCARD_SOURCE_URI]
+    assert storage.manifest["files"] == {}
+    assert "pending" not in storage.manifest
+    assert storage.list_blob_names(BUCKET_NAME, prefix="archive/") == []
+    assert len(storage.list_blob_names(BUCKET_NAME, "interim_article_data_")) == 3
+
+
+def test_compact_interim_article_data_concurrent_run(storage):
+    add_monthly_blobs(storage)
+    storage.failing_manifest_writes = {1: PreconditionFailed("manifest has changed")}
+
+    with pytest.raises(PreconditionFailed):
+        compact_interim_article_data(params=CompactInterimArticleDataParams())
+
+    assert FakeBigqueryClient.updates == []
+    assert storage.list_blob_names(BUCKET_NAME, prefix="archive/") == []
+
+
+def test_compact_interim_article_data_pending_run(storage):
+    add_monthly_blobs(storage)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    storage.put(
+        "manifest.json",
+        json.dumps(
+            {
+                "version": None,
+                "files": {},
+                "superseded_files": {},
+                "pending": {
+                    "version": "v1",
+                    "started_at": now.isoformat(),
+                    "previous_source_uris": [WILDCARD_SOURCE_URI],
+                },
+            }
+        ).encode(),
+    )
+
+    with pytest.raises(RuntimeError, match="still in progress"):
+        compact_interim_article_data(params=CompactInterimArticleDataParams())
+
+    assert FakeBigqueryClient.updates == []
+
+
+def test_compact_interim_article_data_nothing_to_compact(storage):
+    swapped_at = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+        days=2
+    )
+    storage.put("compacted/v1/interim_article_data_2019.parquet", b"old")
+    storage.put("compacted/v2/interim_article_data_2019.parquet", b"new")
+    storage.put("interim_article_data_2020_1.parquet", b"newest")
+    storage.put(
+        "manifest.json",
+        json.dumps(
+            {
+                "version": "v2",
+                "files": {"2019": "compacted/v2/interim_article_data_2019.parquet"},
+                "superseded_files": {
+                    "compacted/v1/interim_article_data_2019.parquet": swapped_at.isoformat()
+                },
+            }
+        ).encode(),
+    )
+    # Left by a run that failed before restoring the wildcard
+    FakeBigqueryClient.source_uris = [
+        f"gs://{BUCKET_NAME}/compacted/v2/interim_article_data_2019.parquet",
+        f"gs://{BUCKET_NAME}/interim_article_data_2020_1.parquet",
+    ]
+
+    compact_interim_article_data(params=CompactInterimArticleDataParams())
+
+    assert "compacted/v1/interim_article_data_2019.parquet" not in storage.blobs
+    assert storage.manifest["superseded_files"] == {}
+    assert "pending" not in storage.manifest
+    assert FakeBigqueryClient.source_uris == [
+        f"gs://{BUCKET_NAME}/compacted/v2/interim_article_data_2019.parquet",
+        WILDCARD_SOURCE_URI,
+    ]
+
+
+def test_archive_interim_article_data_after_partial_failure(storage):
+    # An earlier attempt moved the first month before failing
+    storage.put("archive/interim_article_data_2019_1.parquet", b"1")
+    storage.put("interim_article_data_2019_2.parquet", b"2")
+
+    @flow
+    def archive():
+        archive_interim_article_data(
+            bucket_name=BUCKET_NAME,
+            blob_names=[
+                "interim_article_data_2019_1.parquet",
+                "interim_article_data_2019_2.parquet",
+            ],
+            archive_prefix="archive",
+        )
+
+    archive()
+
+    assert storage.list_blob_names(BUCKET_NAME) == [
+        "archive/interim_article_data_2019_1.parquet",
+        "archive/interim_article_data_2019_2.parquet",
+    ]